@@ -8,22 +8,61 @@ Configuration:
 - BASE_URL: The API endpoint
 - API_KEY: API key
 - MODEL_NAME: The model to use for summarization
+- LLM_CONCURRENCY (environment variable): Maximum concurrent requests, 20 by default
+
+Options:
+- --semantic-cache: Reuse the summaries of near-duplicate pages from previous runs
 '''
 from __future__ import annotations
 
 import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
+import hashlib
 import json
 import os
+import random
+import re
 import sys
-from typing import Dict, List
+from typing import (
+    TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Dict, List, Set, Tuple
+)
 
+import diskcache
+import httpx
 import openai
 import pymupdf
+import tiktoken
+
+if TYPE_CHECKING:
+    import numpy as np
 
 PDF_FILE = sys.argv[1]
+SEMANTIC_CACHE = '--semantic-cache' in sys.argv[2:]
 BASE_URL = 'https://api.openai.com/v1'
 API_KEY = ''
 MODEL_NAME = 'gpt-4.1-mini'
+CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', '20'))  # Concurrent requests
+REQUEST_TIMEOUT = 600.0  # Seconds to wait for a response, as the OpenAI client default
+MAX_BACKOFF = 30  # Maximum delay in seconds between retries
+TOKEN_BUDGET = 60000  # Input token budget of the pages per summarize request
+CONTEXT_WINDOW = 128000  # Context window assumed for the model, in tokens
+OUTPUT_RESERVE = 16384  # Tokens of the context window kept for the output
+PAGES_PER_BATCH = 20  # Bound the JSON output size per summarize request
+MERGE_BUDGET = 80000  # Characters of page summaries merged without gathering
+EMBEDDING_MODEL = 'text-embedding-3-small'
+EMBEDDING_MAX_TOKENS = 8191  # Input limit of the embedding model
+SEMANTIC_CACHE_THRESHOLD = 0.95  # Minimum cosine similarity for a cache hit
+MIN_PAGE_CHARS = 200  # Pages with less text are not summarized
+MIN_PAGE_LINES = 5
+# Reference entries, DOIs and arXiv identifiers, counted per line of the
+# reference list of a page
+REFERENCE_PATTERN = re.compile(r'^\s*\[\d+\]|doi\.org|arXiv:', re.MULTILINE)
+REFERENCE_DENSITY = 0.15
+SECTIONS = ('introduction', 'method', 'contribution', 'experiment', 'discussion')
 SUMMARIZE_PROMPT = '''
 ## Role
 
@@ -31,7 +70,7 @@ SUMMARIZE_PROMPT = '''
 
 ## Instruction
 
-请你阅读接下来给出的论文文本，识别并总结其主要内容。你的总结应重点关注以下内容（当且仅当文本中存在对应内容时）
+接下来给出的论文文本包含多个页面，每个页面以`===PAGE k===`开头。请你逐页阅读，识别并总结每一页的主要内容。你的总结应重点关注以下内容（当且仅当文本中存在对应内容时）
 
 * 研究问题（作者试图解决什么问题）
 * 方法简介（作者是如何解决这个问题的）、简要的方法归属（方法和什么经典方法或已有工作相关）
@@ -39,27 +78,54 @@ SUMMARIZE_PROMPT = '''
 * 实验或结果简述
 * 对结果的讨论
 
-请你针对以上每个部分给出简洁明了的总结。按照相应的格式输出：
+请你针对每一页的以上每个部分给出简洁明了的总结。按照相应的格式输出：
 
 ## Output
 
 你的最终输出应当：
 
-1. 应当仅包括一个 JSON 对象，**不包含任何额外的文本描述**
-2. **不包含markdown格式**等任何不利于直接解析的额外文本
-3. 确保Json格式正确，严格使用**双引号**包裹所有键和值
-4. 如果页面中不存在某个部分，请**不要编造内容**，而是将对应字段留空即可。
+1. 如果页面中不存在某个部分，请**不要编造内容**，而是将对应字段留空即可。
+2. `pages`数组中的元素与输入的页面一一对应，顺序一致，数量相同。
 
 Json包含以下字段。
 
 {
-    'introduction': '...',
-    'method': '...',
-    'contribution': '...',
-    'experiment': '...'
-    'discussion': '...'
+    'pages': [
+        {
+            'introduction': '...',
+            'method': '...',
+            'contribution': '...',
+            'experiment': '...'
+            'discussion': '...'
+        },
+        ...
+    ]
 }
 '''.strip()
+# Structured output format of SUMMARIZE_PROMPT, enforced by the API
+SUMMARIZE_FORMAT = {
+    'type': 'json_schema',
+    'json_schema': {
+        'name': 'summary',
+        'strict': True,
+        'schema': {
+            'type': 'object',
+            'properties': {
+                'pages': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {key: {'type': 'string'} for key in SECTIONS},
+                        'required': list(SECTIONS),
+                        'additionalProperties': False
+                    }
+                }
+            },
+            'required': ['pages'],
+            'additionalProperties': False
+        }
+    }
+}
 GATHER_PROMPT = '''
 ## Role
 
@@ -67,7 +133,7 @@ GATHER_PROMPT = '''
 
 ## Instruction
 
-以下是一篇论文的{section}部分的内容。请你将这些内容合并成一个完整的段落，确保逻辑连贯、语句通顺。并确保内容保持和原文一致。当内容出现冲突时，以多数内容为准。
+以下是一篇论文某一部分的内容，`## Section`下给出该部分的名称，`## Content`下给出该部分的内容。请你将这些内容合并成一个完整的段落，确保逻辑连贯、语句通顺。并确保内容保持和原文一致。当内容出现冲突时，以多数内容为准。
 
 ## Output
 
@@ -87,6 +153,14 @@ MERGE_PROMPT = '''
 2. 你也可以用其他来自amsmath、amssymb、geometry包，以及原生的LaTeX特性。
 3. 你不需要输出上下的preamble部分，或是环境的`\\begin`和`\\end`等。
 '''
+# System messages are kept byte-identical at the head of every request so that
+# the shared prefix can be served from the provider's prompt cache
+SUMMARIZE_MESSAGE = {'role': 'system', 'content': SUMMARIZE_PROMPT}
+GATHER_MESSAGE = {'role': 'system', 'content': GATHER_PROMPT}
+MERGE_MESSAGE = {'role': 'system', 'content': MERGE_PROMPT}
+# Route all requests of the same PDF to the same prompt cache
+PROMPT_CACHE_KEY = hashlib.sha1(PDF_FILE.encode()).hexdigest()
+RESPONSE_CACHE_EXPIRE = 7 * 86400  # Seconds
 
 
 class Usage():
@@ -99,59 +173,87 @@ class Usage():
             cls._instance.input_tokens = 0
             cls._instance.output_tokens = 0
             cls._instance.cached_tokens = 0
+            cls._instance.embedding_tokens = 0
         return cls._instance
 
     def update_usage(self, usage: openai.types.CompletionUsage | None):
         if usage is None:
             return
-        self.output_tokens += usage.completion_tokens
-        self.input_tokens += usage.prompt_tokens
+        cached = 0
         if usage.prompt_tokens_details is not None \
                 and usage.prompt_tokens_details.cached_tokens is not None:
-            self.input_tokens -= usage.prompt_tokens_details.cached_tokens
-            self.cached_tokens += usage.prompt_tokens_details.cached_tokens
+            cached = usage.prompt_tokens_details.cached_tokens
+        # Apply each counter in a single in-place update, with no partial state
+        self.input_tokens += usage.prompt_tokens - cached
+        self.output_tokens += usage.completion_tokens
+        self.cached_tokens += cached
+
+    def update_embedding_usage(self, usage: openai.types.create_embedding_response.Usage | None):
+        if usage is None:
+            return
+        self.embedding_tokens += usage.prompt_tokens
 
     def __str__(self):
+        fields = [
+            f'input_tokens={self.input_tokens}',
+            f'output_tokens={self.output_tokens}'
+        ]
         if self.cached_tokens:
-            return (
-                f'Usage(input_tokens={self.input_tokens}, '
-                f'output_tokens={self.output_tokens}, '
-                f'cached_tokens={self.cached_tokens})'
-            )
-        return (
-            f'Usage(input_tokens={self.input_tokens}, '
-            f'output_tokens={self.output_tokens})'
-        )
+            fields.append(f'cached_tokens={self.cached_tokens}')
+        if self.embedding_tokens:
+            fields.append(f'embedding_tokens={self.embedding_tokens}')
+        return f'Usage({", ".join(fields)})'
 
 
 class StorageWithLock():
+    # Lines are kept in an append-only log, removals are recorded as tombstones
+    REMOVED = '-\t'
+
     def __init__(self, name: str):
         self.path = os.path.join(os.path.dirname(
             os.path.abspath(__file__)), name)
-        self.lock_file = f'{self.path}.lock'
-        if not os.path.exists(self.path):
-            open(self.path, 'w').close()
-
-    async def _wait_for_lock(self):
-        while os.path.exists(self.lock_file):
-            await asyncio.sleep(0.1)
-
-    async def _lock(self):
-        while True:
-            try:
-                # Try to create a lock file
-                with open(self.lock_file, 'x'):
-                    return
-            except FileExistsError:
-                # If the lock file exists, wait and retry
-                await self._wait_for_lock()
-
-    async def _unlock(self):
+        self._file = open(self.path, 'a+', encoding='utf-8')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._set, self._dead = self._replay()
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def _replay(self) -> Tuple[Set[str], int]:
+        # Must be called with the lock held
+        lines, dead = set(), 0
+        self._file.seek(0)
+        for l in self._file:
+            l = l.strip()
+            if l.startswith(self.REMOVED):
+                if l[len(self.REMOVED):] in lines:
+                    lines.remove(l[len(self.REMOVED):])
+                    dead += 1
+                dead += 1
+            elif l:
+                if l in lines:
+                    dead += 1
+                lines.add(l)
+        return lines, dead
+
+    def _append(self, line: str):
+        fcntl.flock(self._file, fcntl.LOCK_EX)
         try:
-            # Remove the lock file
-            os.remove(self.lock_file)
-        except FileNotFoundError:
-            pass
+            self._file.write(line + '\n')
+            self._file.flush()
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def _compact(self):
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            # Replay again to keep the lines written by other processes
+            lines, _ = self._replay()
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.writelines(f'{l}\n' for l in lines)
+            self._file.flush()
+            self._dead = 0
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
 
     async def check_exists(self, line: str) -> bool:
         '''
@@ -162,16 +264,7 @@ class StorageWithLock():
         Returns:
             bool: True if the line exists, False otherwise.
         '''
-        await self._lock()
-        exists = False
-        with open(self.path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        for l in lines:
-            if l.strip() == line.strip():
-                exists = True
-                break
-        await self._unlock()
-        return exists
+        return line.strip() in self._set
 
     async def add_line(self, line: str):
         '''
@@ -180,10 +273,11 @@ class StorageWithLock():
         Args:
             line (str): The line to add.
         '''
-        await self._lock()
-        with open(self.path, 'a', encoding='utf-8') as f:
-            f.write(line.strip() + '\n')
-        await self._unlock()
+        line = line.strip()
+        if line in self._set:
+            return
+        self._set.add(line)
+        await asyncio.to_thread(self._append, line)
 
     async def remove_line(self, line: str):
         '''
@@ -192,82 +286,422 @@ class StorageWithLock():
         Args:
             line (str): The line to remove.
         '''
-        await self._lock()
-        with open(self.path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        with open(self.path, 'w', encoding='utf-8') as f:
-            for l in lines:
-                if l.strip() != line.strip():
-                    f.write(l)
-        await self._unlock()
+        line = line.strip()
+        if line not in self._set:
+            return
+        self._set.remove(line)
+        await asyncio.to_thread(self._append, self.REMOVED + line)
+        self._dead += 2
+        if self._dead > 0.5 * len(self._set):
+            await asyncio.to_thread(self._compact)
+
+
+class SemanticCache():
+    # faiss and numpy are only imported when the semantic cache is enabled
+    def __init__(self, name: str):
+        self.path = os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), name)
+        self.index_file = f'{self.path}.faiss'
+        self.summary_file = f'{self.path}.json'
+        self.lock_file = f'{self.path}.lock'
+        self.index, self.summaries = self._load()
+        # Entries inserted by this run, merged into the files on save
+        self._vectors = []
+        self._new_summaries = []
+
+    def _load(self) -> Tuple[Any, List[Dict[str, str]]]:
+        import faiss
+
+        if not os.path.exists(self.index_file) \
+                or not os.path.exists(self.summary_file):
+            return None, []
+        index = faiss.read_index(self.index_file)
+        with open(self.summary_file, 'r', encoding='utf-8') as f:
+            summaries = json.load(f)
+        return index, summaries
+
+    async def embed(
+        self, llm: openai.AsyncClient, pages: List[str],
+        sem: asyncio.Semaphore | None = None, retry: int = 5
+    ) -> np.ndarray:
+        '''
+        Embeds the pages into normalized vectors.
+
+        Args:
+            llm (openai.AsyncClient): The OpenAI client for making requests.
+            pages (List[str]): The content of the pages to embed.
+            sem (asyncio.Semaphore | None): Optional semaphore for limiting concurrency.
+            retry (int): Number of retries in case of failure.
+        Returns:
+            np.ndarray: The normalized vectors, zero for blank pages.
+        '''
+        import faiss
+        import numpy as np
+
+        indices = [i for i, page in enumerate(pages) if page.strip()]
+        if not indices:
+            return np.zeros((len(pages), 1), dtype=np.float32)
+        inputs = []
+        for i in indices:
+            # A text never has more tokens than UTF-8 bytes
+            if len(pages[i].encode()) > EMBEDDING_MAX_TOKENS:
+                encoding = get_encoding(EMBEDDING_MODEL)
+                inputs.append(encoding.decode(
+                    encoding.encode(pages[i])[:EMBEDDING_MAX_TOKENS]
+                ))
+            else:
+                inputs.append(pages[i])
+
+        async with sem or contextlib.AsyncExitStack():
+            response = await retry_request(functools.partial(
+                llm.embeddings.create, model=EMBEDDING_MODEL, input=inputs
+            ), retry)
+        Usage().update_embedding_usage(response.usage)
+        embeddings = np.array(
+            [item.embedding for item in response.data], dtype=np.float32
+        )
+        faiss.normalize_L2(embeddings)
+        vectors = np.zeros((len(pages), embeddings.shape[1]), dtype=np.float32)
+        vectors[indices] = embeddings
+        return vectors
+
+    def lookup(self, vectors: np.ndarray) -> List[Dict[str, str] | None]:
+        '''
+        Looks up the summaries of the most similar cached pages.
 
+        Args:
+            vectors (np.ndarray): The normalized vectors of the pages.
+        Returns:
+            List[Dict[str, str] | None]: The cached summary of each page,
+                None if no cached page is similar enough.
+        '''
+        if self.index is None or self.index.ntotal == 0 \
+                or self.index.d != vectors.shape[1]:
+            return [None] * len(vectors)
+        scores, ids = self.index.search(vectors, 1)
+        return [
+            self.summaries[i] if score >= SEMANTIC_CACHE_THRESHOLD else None
+            for score, i in zip(scores[:, 0], ids[:, 0])
+        ]
+
+    def insert(self, vectors: np.ndarray, summaries: List[Dict[str, str]]):
+        '''
+        Inserts the summaries of pages into the cache.
+
+        Args:
+            vectors (np.ndarray): The normalized vectors of the pages.
+            summaries (List[Dict[str, str]]): The summary of each page.
+        '''
+        import faiss
+
+        # Skip blank pages and failed summaries
+        keep = [
+            i for i, summary in enumerate(summaries)
+            if vectors[i].any() and any(summary.values())
+        ]
+        if not keep:
+            return
+        if self.index is None or self.index.d != vectors.shape[1]:
+            self.index = faiss.IndexFlatIP(vectors.shape[1])
+            self.summaries = []
+        self.index.add(vectors[keep])
+        self.summaries.extend(summaries[i] for i in keep)
+        self._vectors.append(vectors[keep])
+        self._new_summaries.extend(summaries[i] for i in keep)
+
+    def save(self):
+        '''
+        Merges the entries inserted by this run into the cache on disk.
+        '''
+        import faiss
+        import numpy as np
 
-def read_document(path: str):
+        if not self._vectors:
+            return
+        vectors = np.concatenate(self._vectors)
+        with open(self.lock_file, 'a') as lock:
+            # Other runs may have saved since this one loaded the cache
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index, summaries = self._load()
+            if index is None or index.d != vectors.shape[1]:
+                index, summaries = faiss.IndexFlatIP(vectors.shape[1]), []
+            index.add(vectors)
+            summaries.extend(self._new_summaries)
+
+            faiss.write_index(index, f'{self.index_file}.tmp')
+            with open(f'{self.summary_file}.tmp', 'w', encoding='utf-8') as f:
+                json.dump(summaries, f, ensure_ascii=False)
+            os.replace(f'{self.index_file}.tmp', self.index_file)
+            os.replace(f'{self.summary_file}.tmp', self.summary_file)
+        self._vectors, self._new_summaries = [], []
+
+
+async def iter_pages(path: str) -> AsyncIterator[str]:
     '''
-    Reads a PDF document and extracts its text content.
+    Reads a PDF document and yields the text content of each page as it is extracted.
 
     Args:
         path (str): The file path to the PDF document.
+    Yields:
+        str: The extracted text content of each page.
+    '''
+    loop = asyncio.get_running_loop()
+    # PyMuPDF is not thread safe, so a single thread keeps the document
+    # off the event loop
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        pdf = await loop.run_in_executor(executor, pymupdf.open, path)
+        try:
+            for page_num in range(len(pdf)):
+                yield await loop.run_in_executor(
+                    executor, lambda i=page_num: pdf.load_page(i).get_text()
+                )
+        finally:
+            await loop.run_in_executor(executor, pdf.close)
+
+
+@functools.lru_cache(maxsize=None)
+def get_response_cache() -> diskcache.Cache:
+    '''
+    Opens the persistent cache of LLM responses, shared by all runs of the script.
+
+    Returns:
+        diskcache.Cache: The response cache.
+    '''
+    return diskcache.Cache(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '.llm_cache'))
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = MODEL_NAME) -> tiktoken.Encoding:
+    '''
+    Loads the tokenizer of a model once.
+
+    Args:
+        model (str): The model, MODEL_NAME by default.
+    Returns:
+        tiktoken.Encoding: The tokenizer of the model, or the GPT-4o
+            tokenizer if the model is unknown to tiktoken.
+    '''
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.encoding_for_model('gpt-4o')
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_budget() -> int:
+    '''
+    Computes the input token budget of the pages in a summarize request.
+
+    Returns:
+        int: The token budget, bounded by the context window left after the
+            system prompt and the output.
+    '''
+    system_tokens = len(get_encoding().encode(SUMMARIZE_PROMPT))
+    return min(TOKEN_BUDGET, CONTEXT_WINDOW - system_tokens - OUTPUT_RESERVE)
+
+
+def is_trivial_page(content: str) -> bool:
+    '''
+    Checks if a page has nothing worth summarizing, e.g. blank pages,
+    copyright notices and reference lists.
+
+    Args:
+        content (str): The text content of the page.
+    Returns:
+        bool: True if the page can be skipped, False otherwise.
+    '''
+    content = content.strip()
+    if len(content) < MIN_PAGE_CHARS or content.count('\n') < MIN_PAGE_LINES:
+        return True
+    first = REFERENCE_PATTERN.search(content)
+    if first is None:
+        return False
+    # Body text before the reference list, e.g. a conclusion, is summarized
+    if len(content[:first.start()].strip()) >= MIN_PAGE_CHARS:
+        return False
+    references = content[first.start():]
+    return len(REFERENCE_PATTERN.findall(references)) \
+        > REFERENCE_DENSITY * (references.count('\n') + 1)
+
+
+async def pack_pages(pages: AsyncIterator[str]) -> AsyncIterator[List[str]]:
+    '''
+    Packs consecutive pages into groups bounded by the token budget. Pages
+    exceeding the budget on their own are split into several parts.
+
+    Args:
+        pages (AsyncIterator[str]): The text content of each page.
+    Yields:
+        List[str]: The groups of consecutive pages.
+    '''
+    encoding, budget = get_encoding(), get_token_budget()
+    group, tokens = [], 0
+    async for page in pages:
+        page_tokens = encoding.encode(page)
+        for start in range(0, max(len(page_tokens), 1), budget):
+            part_tokens = page_tokens[start:start + budget]
+            part = page if len(part_tokens) == len(page_tokens) \
+                else encoding.decode(part_tokens)
+            if group and (
+                tokens + len(part_tokens) > budget or len(group) >= PAGES_PER_BATCH
+            ):
+                yield group
+                group, tokens = [], 0
+            group.append(part)
+            tokens += len(part_tokens)
+    if group:
+        yield group
+
+
+def backoff_delay(error: Exception, attempt: int) -> float:
+    '''
+    Computes the delay before retrying a failed request, using exponential
+    backoff with jitter and honoring the `Retry-After` header of rate limits.
+
+    Args:
+        error (Exception): The error raised by the request.
+        attempt (int): The number of the failed attempt, starting from 0.
     Returns:
-        str: The extracted text content from the PDF.
+        float: The delay in seconds.
+    '''
+    jitter = random.random()
+    if isinstance(error, openai.RateLimitError):
+        try:
+            return float(error.response.headers['retry-after']) + jitter
+        except (KeyError, ValueError):
+            pass
+    elif isinstance(error, openai.APIConnectionError):
+        # Transient network errors usually recover quickly
+        return min(0.5 * 2 ** attempt, MAX_BACKOFF) * jitter
+    return min(2 ** attempt, MAX_BACKOFF) + jitter
+
+
+class NonRetryableError(RuntimeError):
+    '''
+    Raised by a request that must not be retried.
+    '''
+
+
+async def retry_request(request: Callable[[], Awaitable[Any]], retry: int = 5) -> Any:
+    '''
+    Calls a request until it succeeds, backing off between failed attempts.
+
+    Args:
+        request (Callable[[], Awaitable[Any]]): Starts one attempt of the request.
+        retry (int): Number of retries in case of failure.
+    Returns:
+        Any: The result of the first successful attempt.
+    Raises:
+        Exception: The error of the last attempt, or a NonRetryableError.
+    '''
+    for attempt in range(retry - 1):
+        try:
+            return await request()
+        except NonRetryableError:
+            raise
+        except Exception as e:
+            await asyncio.sleep(backoff_delay(e, attempt))
+    return await request()
+
+
+async def cached_chat(
+    llm: openai.AsyncClient, messages: List[Dict[str, str]],
+    parse: Callable[[str], Any] | None = None,
+    on_delta: Callable[[str], None] | None = None, **kwargs
+) -> Any:
     '''
-    with pymupdf.open(path) as pdf:
-        # Extract text
-        text = []
-        for page_num in range(len(pdf)):
-            page = pdf.load_page(page_num)
-            text.append(page.get_text())
+    Requests a chat completion, serving repeated requests from the response cache.
 
-    return text
+    Args:
+        llm (openai.AsyncClient): The OpenAI client for making requests.
+        messages (List[Dict[str, str]]): The messages of the request.
+        parse (Callable[[str], Any] | None): Optional parser applied to the
+            response content. Responses failing to parse are not cached.
+        on_delta (Callable[[str], None] | None): Optional callback to stream
+            the response content to as it arrives.
+        **kwargs: Extra arguments of the request, e.g. `response_format`.
+    Returns:
+        Any: The (parsed) response content.
+    '''
+    key = hashlib.sha256(json.dumps(
+        [MODEL_NAME, messages, kwargs], ensure_ascii=False, sort_keys=True
+    ).encode()).hexdigest()
+    content = get_response_cache().get(key)
+    if content is not None:
+        if on_delta:
+            on_delta(content)
+        return parse(content) if parse else content
+
+    if on_delta:
+        stream = await llm.chat.completions.create(
+            model=MODEL_NAME,
+            messages=messages,
+            extra_body={'prompt_cache_key': PROMPT_CACHE_KEY},
+            stream=True,
+            stream_options={'include_usage': True},
+            **kwargs
+        )
+        deltas = []
+        async for chunk in stream:
+            # The usage arrives in a last chunk without choices
+            if chunk.choices and chunk.choices[0].delta.content:
+                on_delta(chunk.choices[0].delta.content)
+                deltas.append(chunk.choices[0].delta.content)
+            Usage().update_usage(chunk.usage)
+        content = ''.join(deltas).strip()
+    else:
+        response = await llm.chat.completions.create(
+            model=MODEL_NAME,
+            messages=messages,
+            extra_body={'prompt_cache_key': PROMPT_CACHE_KEY},
+            **kwargs
+        )
+        Usage().update_usage(response.usage)
+        content = response.choices[0].message.content.strip()
+    result = parse(content) if parse else content
+    get_response_cache().set(key, content, expire=RESPONSE_CACHE_EXPIRE)
+    return result
 
 
 async def summarize_content(
-    llm: openai.AsyncClient, content: str, sem: asyncio.Semaphore | None = None, retry: int = 5
-) -> Dict[str, str]:
+    llm: openai.AsyncClient, pages: List[str], sem: asyncio.Semaphore | None = None, retry: int = 5
+) -> List[Dict[str, str]]:
     '''
-    Summarizes the content using OpenAI's language model.
+    Summarizes a group of pages in a single request using OpenAI's language model.
 
     Args:
         llm (openai.AsyncClient): The OpenAI client for making requests.
-        content (str): The content to summarize.
+        pages (List[str]): The content of the pages to summarize.
         sem (asyncio.Semaphore | None): Optional semaphore for limiting concurrency.
         retry (int): Number of retries in case of failure.
     Returns:
-        str: The summary of the content.
+        List[Dict[str, str]]: The summary of each page.
     '''
-    if sem:
-        async with sem:
-            return await summarize_content(llm, content, None, retry)
-
-    while retry > 0:
+    def parse(summary: str) -> List[Dict[str, str]]:
+        # Normalize within the parser so that malformed responses are not cached
+        results = [
+            {key: page.get(key, '') for key in SECTIONS}
+            for page in json.loads(summary)['pages'][:len(pages)]
+        ]
+        # Keep one summary per page even if the model merged some pages
+        results += [
+            {key: '' for key in SECTIONS}
+            for _ in range(len(pages) - len(results))
+        ]
+        return results
+
+    content = ''.join(
+        f'\n\n===PAGE {i}===\n' + page for i, page in enumerate(pages, 1)
+    ).strip()
+    async with sem or contextlib.AsyncExitStack():
         try:
-            response = await llm.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[
-                    {'role': 'system', 'content': SUMMARIZE_PROMPT},
-                    {'role': 'user', 'content': content}
-                ]
-            )
-            Usage().update_usage(response.usage)
-            summary = response.choices[0].message.content.strip()
-            summary_dict = json.loads(summary)
-            return {
-                'introduction': summary_dict.get('introduction', ''),
-                'method': summary_dict.get('method', ''),
-                'contribution': summary_dict.get('contribution', ''),
-                'experiment': summary_dict.get('experiment', ''),
-                'discussion': summary_dict.get('discussion', '')
-            }
-        except Exception as e:
-            await asyncio.sleep(1)
-            retry -= 1
-    return {
-        'introduction': '',
-        'method': '',
-        'contribution': '',
-        'experiment': '',
-        'discussion': ''
-    }
+            return await retry_request(functools.partial(cached_chat, llm, [
+                SUMMARIZE_MESSAGE,
+                {'role': 'user', 'content': content}
+            ], parse, response_format=SUMMARIZE_FORMAT), retry)
+        except Exception:
+            return [{key: '' for key in SECTIONS} for _ in pages]
 
 
 async def gather_content(
@@ -284,31 +718,20 @@ async def gather_content(
     Returns:
         str: The merged content string.
     '''
-    if sem:
-        async with sem:
-            return await gather_content(llm, section, content, None, retry)
-    while retry > 0:
+    async with sem or contextlib.AsyncExitStack():
         try:
-            response = await llm.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[
-                    {'role': 'system', 'content': GATHER_PROMPT.format(
-                        section=section)},
-                    {'role': 'user', 'content': '\n'.join(
-                        [f'* {_}' for _ in content])}
-                ]
-            )
-            Usage().update_usage(response.usage)
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            await asyncio.sleep(1)
-            retry -= 1
-    return ''
+            return await retry_request(functools.partial(cached_chat, llm, [
+                GATHER_MESSAGE,
+                {'role': 'user', 'content': f'## Section\n{section}\n\n## Content\n'
+                    + '\n'.join([f'* {_}' for _ in content])}
+            ]), retry)
+        except Exception:
+            return ''
 
 
 async def merge_sections(
     llm: openai.AsyncClient, document: Dict[str, str],
-    sem: asyncio.Semaphore | None = None, retry: int = 5
+    sem: asyncio.Semaphore | None = None, retry: int = 5, stream: bool = False
 ) -> str:
     '''
     Merges sections of the document into a single string.
@@ -318,30 +741,92 @@ async def merge_sections(
         document (Dict[str, str]): The document with sections to merge.
         sem (asyncio.Semaphore | None): Optional semaphore for limiting concurrency.
         retry (int): Number of retries in case of failure.
+        stream (bool): Whether to write the content to stdout as it arrives.
     Returns:
         str: The merged content string.
     '''
-    if sem:
-        async with sem:
-            return await merge_sections(llm, document, None, retry)
-
-    while retry > 0:
+    written, pending = [], ''
+
+    def write(delta: str):
+        # Strip the streamed content as a whole, holding back trailing
+        # whitespace until more content follows
+        nonlocal pending
+        text = pending + delta
+        if not written:
+            text = text.lstrip()
+        content = text.rstrip()
+        pending = text[len(content):]
+        if content:
+            sys.stdout.write(content)
+            sys.stdout.flush()
+            written.append(content)
+
+    async def request() -> str:
         try:
-            response = await llm.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[
-                    {'role': 'system', 'content': MERGE_PROMPT},
-                    {'role': 'user', 'content': '\n'.join([
-                        f'{key}: {value}' for key, value in document.items()
-                    ])}
-                ]
-            )
-            Usage().update_usage(response.usage)
-            return response.choices[0].message.content.strip()
+            return await cached_chat(llm, [
+                MERGE_MESSAGE,
+                {'role': 'user', 'content': '\n'.join([
+                    f'{key}: {value}' for key, value in document.items()
+                ])}
+            ], on_delta=write if stream else None)
         except Exception as e:
-            await asyncio.sleep(1)
-            retry -= 1
-    return ''
+            if written:
+                # Retrying would repeat the content already written, fail
+                # instead of passing a truncated summary off as complete
+                raise NonRetryableError(
+                    'The merged summary was interrupted while streaming.'
+                ) from e
+            raise
+
+    async with sem or contextlib.AsyncExitStack():
+        try:
+            return await retry_request(request, retry)
+        except NonRetryableError:
+            raise
+        except Exception:
+            return ''
+
+
+async def summarize_pages(
+    llm: openai.AsyncClient, pages: List[str], sem: asyncio.Semaphore | None = None,
+    semantic_cache: SemanticCache | None = None
+) -> List[Dict[str, str]]:
+    '''
+    Summarizes a group of pages, skipping trivial pages and reusing the
+    semantic cache when given.
+
+    Args:
+        llm (openai.AsyncClient): The OpenAI client for making requests.
+        pages (List[str]): The content of the pages to summarize.
+        sem (asyncio.Semaphore | None): Optional semaphore for limiting concurrency.
+        semantic_cache (SemanticCache | None): Optional semantic cache.
+    Returns:
+        List[Dict[str, str]]: The summary of each page.
+    '''
+    # Blank and reference-only pages get empty summaries without a request
+    results = [{key: '' for key in SECTIONS} for _ in pages]
+    informative = [i for i, page in enumerate(pages) if not is_trivial_page(page)]
+    contents = [pages[i] for i in informative]
+    cached = [None] * len(contents)
+    if semantic_cache and contents:
+        try:
+            vectors = await semantic_cache.embed(llm, contents, sem)
+            cached = semantic_cache.lookup(vectors)
+        except Exception:
+            # Fall back to summarizing every page
+            semantic_cache = None
+    misses = [i for i, summary in enumerate(cached) if summary is None]
+    summaries = await summarize_content(
+        llm, [contents[i] for i in misses], sem
+    ) if misses else []
+    if semantic_cache and misses:
+        semantic_cache.insert(vectors[misses], summaries)
+
+    for i, summary in zip(misses, summaries):
+        cached[i] = summary
+    for i, summary in zip(informative, cached):
+        results[i] = summary
+    return results
 
 
 async def main():
@@ -353,34 +838,62 @@ async def main():
         raise ValueError(f'File {PDF_FILE} is already being processed.')
     await storage.add_line(PDF_FILE)
 
-    document = read_document(PDF_FILE)
-    llm = openai.AsyncOpenAI(api_key=API_KEY, base_url=BASE_URL)
-    sem = asyncio.Semaphore(5)  # Limit concurrent requests
-    results = await asyncio.gather(
-        *[summarize_content(llm, page, sem) for page in document]
-    )
-
-    sections = {}
-    for i, result in enumerate(results):
-        for key, value in result.items():
-            if key not in sections:
-                sections[key] = []
-            sections[key].append(value)
-
-    gathered_sections = {
-        k: v
-        for k, v in zip(sections, await asyncio.gather(*[
-            gather_content(llm, key, sections[key], sem) for key in sections
-        ]))
-    }
-    merged_content = await merge_sections(llm, gathered_sections, sem)
-    # Fix % issue in bibtex
-    print(merged_content, end='\\par\n')
-    print('\\noindent\\rule{\\linewidth}{1pt}', end='\\par\n')
-    print(f'Endpoint: {BASE_URL}', end='\\par\n')
-    print(f'Model: {MODEL_NAME}', end='\\par\n')
-    print(str(Usage()).replace('_', '\\_'))
-    await storage.remove_line(PDF_FILE)
+    try:
+        # Multiplex all requests over a few long-lived HTTP/2 connections
+        http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=64, max_keepalive_connections=32, keepalive_expiry=60
+            ),
+            # Batched requests send nothing until their whole JSON output is done
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=5.0)
+        )
+        # Retries are handled by the request functions
+        llm = openai.AsyncOpenAI(
+            api_key=API_KEY, base_url=BASE_URL, http_client=http_client, max_retries=0
+        )
+        sem = asyncio.Semaphore(CONCURRENCY)  # Limit concurrent requests
+        semantic_cache = SemanticCache('semantic_cache') if SEMANTIC_CACHE else None
+        # Summarize each group of pages as soon as it is extracted
+        tasks = []
+        async for group in pack_pages(iter_pages(PDF_FILE)):
+            tasks.append(asyncio.create_task(
+                summarize_pages(llm, group, sem, semantic_cache)
+            ))
+        results = [
+            page for group in await asyncio.gather(*tasks) for page in group
+        ]
+        if semantic_cache:
+            semantic_cache.save()
+
+        sections = collections.defaultdict(list)
+        for result in results:
+            for key, value in result.items():
+                sections[key].append(value)
+
+        if sum(len(v) for vs in sections.values() for v in vs) < MERGE_BUDGET:
+            # Short enough to merge the page summaries directly in one request
+            gathered_sections = {
+                k: '\n'.join([''] + [f'* {v}' for v in vs if v])
+                for k, vs in sections.items()
+            }
+        else:
+            gathered_sections = {
+                k: v
+                for k, v in zip(sections, await asyncio.gather(*[
+                    gather_content(llm, key, sections[key], sem) for key in sections
+                ]))
+            }
+        # The merged content is written to stdout as it arrives
+        await merge_sections(llm, gathered_sections, sem, stream=True)
+        # Fix % issue in bibtex
+        print(end='\\par\n')
+        print('\\noindent\\rule{\\linewidth}{1pt}', end='\\par\n')
+        print(f'Endpoint: {BASE_URL}', end='\\par\n')
+        print(f'Model: {MODEL_NAME}', end='\\par\n')
+        print(str(Usage()).replace('_', '\\_'))
+    finally:
+        await storage.remove_line(PDF_FILE)
 
 
 if __name__ == '__main__':